@@ -1,5 +1,26 @@
 import struct
 import os
+import numpy as np
+
+KEYFRAME_CACHE_EXT = '.kfidx'
+KEYFRAME_CACHE_MAGIC = b'KFX2'
+LARGE_MDAT_SIZE = 16 * 1024 * 1024
+MOOV_TAIL_SCAN = 64 * 1024
+MVHD_READ_SIZE = 4096
+
+_U32BE = struct.Struct('>I')
+_U64BE = struct.Struct('>Q')
+_BOX_HEADER = struct.Struct('>I4s')
+_STSZ_HEADER = struct.Struct('>II')  # sample_size, sample_count
+_MVHD_V0 = struct.Struct('>II')  # timescale, duration
+_MVHD_V1 = struct.Struct('>IQ')
+
+# Sidecar layout: header of (magic, video mtime_ns, video size), then packed (sample, offset, time) records
+_KF_CACHE_HEADER = struct.Struct('<4sQQ')
+_KF_DTYPE = np.dtype([('s', '<u8'), ('o', '<u8'), ('t', '<f8')])
+
+# (sample_numbers, byte_offsets, times) when a file has no usable sample table
+_NO_KEYFRAMES = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
 
 class MP4Parser:
     """Parse MP4 container to find keyframe positions"""
@@ -7,95 +28,202 @@ class MP4Parser:
     def __init__(self, file_path):
         self.file_path = file_path
         self.keyframes = []  # List of (sample_number, byte_offset, timestamp)
+        self.kf_samples, self.kf_offsets, self.kf_times = _NO_KEYFRAMES
         
     def parse(self):
+        """Parse MP4 structure and extract keyframe info, reusing the on-disk cache when valid"""
+        st = os.stat(self.file_path)
+        columns = self._load_keyframe_cache(st)
+        if columns is None:
+            columns = self._parse_keyframes()
+            if len(columns[0]):
+                self._save_keyframe_cache(st, columns)
+        
+        # Keyframes are kept as parallel arrays; self.keyframes is the list-of-tuples view
+        self.kf_samples, self.kf_offsets, self.kf_times = columns
+        self.keyframes = list(zip(self.kf_samples.tolist(), self.kf_offsets.tolist(), self.kf_times.tolist()))
+        return self.keyframes
+    
+    def read_duration(self):
+        """Movie duration in seconds from the mvhd box, None if it cannot be read"""
+        try:
+            fd = os.open(self.file_path, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            moov_offset, moov_size = self._find_moov(fd, os.fstat(fd).st_size)
+            if not moov_offset:
+                return None
+            # mvhd normally leads the moov box, so read only its head before the whole box
+            duration = self._parse_mvhd(memoryview(os.pread(fd, min(moov_size, MVHD_READ_SIZE), moov_offset)))
+            if duration is None and moov_size > MVHD_READ_SIZE:
+                duration = self._parse_mvhd(memoryview(os.pread(fd, moov_size, moov_offset)))
+        finally:
+            os.close(fd)
+        return duration
+    
+    def _load_keyframe_cache(self, st):
+        """Map keyframes from the sidecar if it matches the video's mtime and size"""
+        cache_file = self.file_path + KEYFRAME_CACHE_EXT
+        try:
+            with open(cache_file, 'rb') as f:
+                header = f.read(_KF_CACHE_HEADER.size)
+            if len(header) < _KF_CACHE_HEADER.size:
+                return None
+            if _KF_CACHE_HEADER.unpack(header) != (KEYFRAME_CACHE_MAGIC, st.st_mtime_ns, st.st_size):
+                return None
+            records = np.memmap(cache_file, dtype=_KF_DTYPE, mode='r', offset=_KF_CACHE_HEADER.size)
+        except (OSError, ValueError):
+            return None
+        return records['s'].astype(np.int64), records['o'].astype(np.int64), records['t'].astype(np.float64)
+    
+    def _save_keyframe_cache(self, st, columns):
+        """Write keyframes to the sidecar as packed little-endian (sample, offset, time) records"""
+        cache_file = self.file_path + KEYFRAME_CACHE_EXT
+        tmp_file = cache_file + '.tmp'
+        records = np.empty(len(columns[0]), dtype=_KF_DTYPE)
+        records['s'], records['o'], records['t'] = columns
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.write(_KF_CACHE_HEADER.pack(KEYFRAME_CACHE_MAGIC, st.st_mtime_ns, st.st_size))
+                records.tofile(f)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            # Footage directories may be read-only; the cache is only an optimization
+            pass
+    
+    def _parse_keyframes(self):
         """Parse MP4 structure and extract keyframe info"""
-        with open(self.file_path, 'rb') as f:
-            file_size = os.path.getsize(self.file_path)
+        fd = os.open(self.file_path, os.O_RDONLY)
+        try:
+            file_size = os.fstat(fd).st_size
             
             # Find moov box
-            moov_offset, moov_size = self._find_box(f, b'moov', 0, file_size)
+            moov_offset, moov_size = self._find_moov(fd, file_size)
             if not moov_offset:
-                return []
-            
-            # Parse moov to get keyframe info
-            f.seek(moov_offset)
-            moov_data = f.read(moov_size)
-            
-            # Find trak box (video track)
-            trak_offset, trak_size = self._find_box_in_data(moov_data, b'trak')
-            if not trak_offset:
-                return []
-            
-            trak_data = moov_data[trak_offset:trak_offset + trak_size]
-            
-            # Find mdia box
-            mdia_offset, mdia_size = self._find_box_in_data(trak_data, b'mdia')
-            if not mdia_offset:
-                return []
-            
-            mdia_data = trak_data[mdia_offset:mdia_offset + mdia_size]
-            
-            # Find minf box
-            minf_offset, minf_size = self._find_box_in_data(mdia_data, b'minf')
-            if not minf_offset:
-                return []
-            
-            minf_data = mdia_data[minf_offset:minf_offset + minf_size]
-            
-            # Find stbl box (sample table)
-            stbl_offset, stbl_size = self._find_box_in_data(minf_data, b'stbl')
-            if not stbl_offset:
-                return []
-            
-            stbl_data = minf_data[stbl_offset:stbl_offset + stbl_size]
-            
-            # Get sync samples (keyframes)
-            keyframe_samples = self._parse_stss(stbl_data)
-            
-            # Get chunk offsets
-            chunk_offsets = self._parse_stco(stbl_data)
-            
-            # Get sample-to-chunk mapping
-            sample_to_chunk = self._parse_stsc(stbl_data)
-            
-            # Get sample sizes
-            sample_sizes = self._parse_stsz(stbl_data)
-            
-            # Map keyframes to byte offsets
-            self.keyframes = self._map_keyframes_to_offsets(
-                keyframe_samples, chunk_offsets, sample_to_chunk, sample_sizes
-            )
+                return _NO_KEYFRAMES
             
-            return self.keyframes
+            # Read the whole moov box in one call; everything below works in memory
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, moov_offset, moov_size, os.POSIX_FADV_WILLNEED)
+            moov_data = os.pread(fd, moov_size, moov_offset)
+        finally:
+            os.close(fd)
+        
+        # Descend moov -> trak (video track) -> mdia -> minf -> stbl (sample table) without copying
+        mdia_data = self._descend(memoryview(moov_data), (b'trak', b'mdia'))
+        if mdia_data is None:
+            return _NO_KEYFRAMES
+        timescale = self._parse_mdhd(mdia_data)
+        stbl_data = self._descend(mdia_data, (b'minf', b'stbl'))
+        if stbl_data is None:
+            return _NO_KEYFRAMES
+        
+        # Get sync samples (keyframes)
+        keyframe_samples = self._parse_stss(stbl_data)
+        
+        # Get chunk offsets
+        chunk_offsets = self._parse_stco(stbl_data)
+        
+        # Get sample-to-chunk mapping
+        sample_to_chunk = self._parse_stsc(stbl_data)
+        
+        # Get sample sizes
+        sample_sizes = self._parse_stsz(stbl_data)
+        
+        # Map keyframes to byte offsets
+        kf_samples, kf_offsets = self._map_keyframes_to_offsets(
+            keyframe_samples, chunk_offsets, sample_to_chunk, sample_sizes
+        )
+        
+        # Get keyframe decode times in seconds
+        kf_times = self._sample_times(kf_samples, self._parse_stts(stbl_data), timescale)
+        return kf_samples, kf_offsets, kf_times
+    
+    def _read_box_header(self, fd, pos, end):
+        """Read box header at pos, returning (size, box_type, header_len)"""
+        header = os.pread(fd, 16, pos)
+        if len(header) < 8:
+            return None, None, None
+        
+        size, box_name = _BOX_HEADER.unpack_from(header)
+        header_len = 8
+        if size == 1:
+            # 64-bit largesize follows the type (large mdat)
+            if len(header) < 16:
+                return None, None, None
+            size = _U64BE.unpack_from(header, 8)[0]
+            header_len = 16
+        elif size == 0:
+            # Box extends to end of file
+            size = end - pos
+        return size, box_name, header_len
     
-    def _find_box(self, f, box_type, start, end):
+    def _find_moov(self, fd, file_size):
+        """Find moov box, checking the end of the file first when a large mdat comes first"""
+        # Recorders usually write mdat first and moov last (QuickTime moov-at-end
+        # layout). If the box after ftyp is a large mdat that ends near EOF,
+        # look for moov in the file tail before walking the top-level boxes.
+        pos = 0
+        size, box_name, _ = self._read_box_header(fd, pos, file_size)
+        if box_name == b'ftyp':
+            pos += size
+            size, box_name, _ = self._read_box_header(fd, pos, file_size)
+        
+        if box_name == b'mdat' and size > LARGE_MDAT_SIZE and file_size - (pos + size) < LARGE_MDAT_SIZE:
+            moov_offset, moov_size = self._find_moov_in_tail(fd, pos + size, file_size)
+            if moov_offset:
+                return moov_offset, moov_size
+        
+        return self._find_box(fd, b'moov', 0, file_size)
+    
+    def _find_moov_in_tail(self, fd, mdat_end, file_size):
+        """Search the last MOOV_TAIL_SCAN bytes for a moov box starting after mdat"""
+        tail_start = max(mdat_end, file_size - MOOV_TAIL_SCAN)
+        tail = os.pread(fd, file_size - tail_start, tail_start)
+        
+        idx = tail.rfind(b'moov')
+        while idx >= 4:
+            # Validate by the 4-byte length preceding the tag
+            size = _U32BE.unpack_from(tail, idx - 4)[0]
+            box_start = tail_start + idx - 4
+            if size >= 8 and box_start + size <= file_size:
+                return box_start + 8, size - 8
+            idx = tail.rfind(b'moov', 0, idx)
+        
+        return None, None
+    
+    def _find_box(self, fd, box_type, start, end):
         """Find box in file"""
-        f.seek(start)
-        while f.tell() < end:
-            pos = f.tell()
-            size_data = f.read(4)
-            if len(size_data) < 4:
+        pos = start
+        while pos < end:
+            size, box_name, header_len = self._read_box_header(fd, pos, end)
+            if size is None:
                 break
             
-            size = struct.unpack('>I', size_data)[0]
-            box_name = f.read(4)
-            
             if box_name == box_type:
-                return pos + 8, size - 8
+                return pos + header_len, size - header_len
             
-            if size == 0:
+            if size < header_len:
                 break
-            f.seek(pos + size)
+            pos += size
         
         return None, None
     
+    def _descend(self, data, path):
+        """Follow a path of nested boxes, returning the innermost payload as a slice of data"""
+        for box_type in path:
+            offset, size = self._find_box_in_data(data, box_type)
+            if not offset:
+                return None
+            data = data[offset:offset + size]
+        return data
+    
     def _find_box_in_data(self, data, box_type):
         """Find box in data buffer"""
         offset = 0
         while offset < len(data) - 8:
-            size = struct.unpack('>I', data[offset:offset+4])[0]
-            box_name = data[offset+4:offset+8]
+            size, box_name = _BOX_HEADER.unpack_from(data, offset)
             
             if box_name == box_type:
                 return offset + 8, size - 8
@@ -106,6 +234,61 @@ class MP4Parser:
         
         return None, None
     
+    def _parse_mvhd(self, moov_data):
+        """Parse mvhd (movie header) box to get the duration in seconds"""
+        offset, size = self._find_box_in_data(moov_data, b'mvhd')
+        if not offset or size < 32:
+            return None
+        
+        data = moov_data[offset:offset+size]
+        # Version 1 uses 64-bit creation/modification times and duration
+        if data[0] == 1:
+            timescale, duration = _MVHD_V1.unpack_from(data, 20)
+            unknown = 0xFFFFFFFFFFFFFFFF
+        else:
+            timescale, duration = _MVHD_V0.unpack_from(data, 12)
+            unknown = 0xFFFFFFFF
+        # An all-ones duration means the duration is not known
+        if not timescale or duration == unknown:
+            return None
+        return duration / timescale
+    
+    def _parse_mdhd(self, mdia_data):
+        """Parse mdhd (media header) box to get the track timescale"""
+        offset, size = self._find_box_in_data(mdia_data, b'mdhd')
+        if not offset:
+            return 0
+        
+        data = mdia_data[offset:offset+size]
+        # Version 1 uses 64-bit creation/modification times
+        return _U32BE.unpack_from(data, 20 if data[0] == 1 else 12)[0]
+    
+    def _parse_stts(self, stbl_data):
+        """Parse stts (time-to-sample) box into (sample_count, sample_delta) rows"""
+        offset, size = self._find_box_in_data(stbl_data, b'stts')
+        if not offset:
+            return []
+        
+        data = stbl_data[offset:offset+size]
+        entry_count = _U32BE.unpack_from(data, 4)[0]
+        
+        return np.frombuffer(data, dtype='>u4', count=entry_count * 2, offset=8).reshape(-1, 2)
+    
+    def _sample_times(self, samples, time_to_sample, timescale):
+        """Decode times in seconds of 1-based sample numbers, NaN without timing info"""
+        if not len(time_to_sample) or not timescale:
+            return np.full(len(samples), np.nan)
+        
+        counts = time_to_sample[:, 0].astype(np.int64)
+        deltas = time_to_sample[:, 1].astype(np.int64)
+        run_first_sample = np.cumsum(counts) - counts
+        run_start_time = np.cumsum(counts * deltas) - counts * deltas
+        
+        # Find each sample's stts run; samples past the table extend the last run
+        idx = np.asarray(samples, dtype=np.int64) - 1
+        run = np.clip(np.searchsorted(run_first_sample, idx, side='right') - 1, 0, None)
+        return (run_start_time[run] + (idx - run_first_sample[run]) * deltas[run]) / timescale
+    
     def _parse_stss(self, stbl_data):
         """Parse stss (sync sample) box to get keyframe sample numbers"""
         offset, size = self._find_box_in_data(stbl_data, b'stss')
@@ -113,15 +296,9 @@ class MP4Parser:
             return []
         
         data = stbl_data[offset:offset+size]
-        version = data[0]
-        entry_count = struct.unpack('>I', data[4:8])[0]
-        
-        keyframes = []
-        for i in range(entry_count):
-            sample_num = struct.unpack('>I', data[8 + i*4:12 + i*4])[0]
-            keyframes.append(sample_num)
+        entry_count = _U32BE.unpack_from(data, 4)[0]
         
-        return keyframes
+        return np.frombuffer(data, dtype='>u4', count=entry_count, offset=8)
     
     def _parse_stco(self, stbl_data):
         """Parse stco (chunk offset) box"""
@@ -136,18 +313,10 @@ class MP4Parser:
             is_64bit = False
         
         data = stbl_data[offset:offset+size]
-        entry_count = struct.unpack('>I', data[4:8])[0]
+        entry_count = _U32BE.unpack_from(data, 4)[0]
         
-        offsets = []
-        entry_size = 8 if is_64bit else 4
-        for i in range(entry_count):
-            if is_64bit:
-                chunk_offset = struct.unpack('>Q', data[8 + i*8:16 + i*8])[0]
-            else:
-                chunk_offset = struct.unpack('>I', data[8 + i*4:12 + i*4])[0]
-            offsets.append(chunk_offset)
-        
-        return offsets
+        dtype = '>u8' if is_64bit else '>u4'
+        return np.frombuffer(data, dtype=dtype, count=entry_count, offset=8)
     
     def _parse_stsc(self, stbl_data):
         """Parse stsc (sample-to-chunk) box"""
@@ -156,15 +325,10 @@ class MP4Parser:
             return []
         
         data = stbl_data[offset:offset+size]
-        entry_count = struct.unpack('>I', data[4:8])[0]
-        
-        entries = []
-        for i in range(entry_count):
-            first_chunk = struct.unpack('>I', data[8 + i*12:12 + i*12])[0]
-            samples_per_chunk = struct.unpack('>I', data[12 + i*12:16 + i*12])[0]
-            entries.append((first_chunk, samples_per_chunk))
+        entry_count = _U32BE.unpack_from(data, 4)[0]
         
-        return entries
+        # Rows of (first_chunk, samples_per_chunk, sample_description_index)
+        return np.frombuffer(data, dtype='>u4', count=entry_count * 3, offset=8).reshape(-1, 3)
     
     def _parse_stsz(self, stbl_data):
         """Parse stsz (sample size) box"""
@@ -173,62 +337,58 @@ class MP4Parser:
             return []
         
         data = stbl_data[offset:offset+size]
-        sample_size = struct.unpack('>I', data[4:8])[0]
-        sample_count = struct.unpack('>I', data[8:12])[0]
+        sample_size, sample_count = _STSZ_HEADER.unpack_from(data, 4)
         
         if sample_size != 0:
             # All samples same size
-            return [sample_size] * sample_count
+            return np.full(sample_count, sample_size, dtype=np.uint32)
         
         # Variable sizes
-        sizes = []
-        for i in range(sample_count):
-            size = struct.unpack('>I', data[12 + i*4:16 + i*4])[0]
-            sizes.append(size)
-        
-        return sizes
+        return np.frombuffer(data, dtype='>u4', count=sample_count, offset=12)
     
     def _map_keyframes_to_offsets(self, keyframe_samples, chunk_offsets, sample_to_chunk, sample_sizes):
-        """Map keyframe sample numbers to byte offsets"""
-        if not keyframe_samples or not chunk_offsets or not sample_sizes:
-            return []
+        """Map keyframe sample numbers to byte offsets, returned as (samples, offsets) arrays"""
+        if not len(keyframe_samples) or not len(chunk_offsets) or not len(sample_to_chunk) or not len(sample_sizes):
+            return _NO_KEYFRAMES[:2]
         
-        # Build sample-to-chunk map
-        sample_num = 1
-        chunk_map = {}  # sample_num -> (chunk_index, offset_in_chunk)
+        n_chunks = len(chunk_offsets)
         
-        for i, (first_chunk, samples_per_chunk) in enumerate(sample_to_chunk):
-            next_first_chunk = sample_to_chunk[i+1][0] if i+1 < len(sample_to_chunk) else len(chunk_offsets) + 1
-            
-            for chunk_idx in range(first_chunk - 1, next_first_chunk - 1):
-                if chunk_idx >= len(chunk_offsets):
-                    break
-                
-                offset_in_chunk = 0
-                for _ in range(samples_per_chunk):
-                    if sample_num - 1 < len(sample_sizes):
-                        chunk_map[sample_num] = (chunk_idx, offset_in_chunk)
-                        offset_in_chunk += sample_sizes[sample_num - 1]
-                        sample_num += 1
-        
-        # Map keyframes to offsets
-        keyframe_offsets = []
-        for kf_sample in keyframe_samples:
-            if kf_sample in chunk_map:
-                chunk_idx, offset_in_chunk = chunk_map[kf_sample]
-                byte_offset = chunk_offsets[chunk_idx] + offset_in_chunk
-                keyframe_offsets.append((kf_sample, byte_offset))
-        
-        return keyframe_offsets
+        # Expand stsc runs to one entry per chunk: run length is the gap to the next first_chunk
+        first_chunks = sample_to_chunk[:, 0].astype(np.int64)
+        next_first = np.append(first_chunks[1:], n_chunks + 1)
+        run_lengths = np.clip(np.minimum(next_first, n_chunks + 1) - first_chunks, 0, None)
+        run_starts = np.repeat(np.cumsum(run_lengths) - run_lengths, run_lengths)
+        chunk_ids = np.repeat(first_chunks - 1, run_lengths) + np.arange(run_starts.size) - run_starts
+        spc = np.repeat(sample_to_chunk[:, 1].astype(np.int64), run_lengths)
+        
+        # Per-sample chunk index and offset within that chunk, capped at the number of sizes in stsz
+        entry_of_sample = np.repeat(np.arange(spc.size), spc)[:len(sample_sizes)]
+        chunk_of_sample = chunk_ids[entry_of_sample]
+        sizes = sample_sizes[:entry_of_sample.size].astype(np.int64)
+        sample_starts = sizes.cumsum() - sizes
+        chunk_first_sample = np.cumsum(spc) - spc
+        offset_of_sample = sample_starts - sample_starts[chunk_first_sample[entry_of_sample]]
+        
+        # Map keyframes to offsets, dropping sample numbers outside the table
+        kf = np.asarray(keyframe_samples, dtype=np.int64)
+        kf = kf[(kf >= 1) & (kf <= chunk_of_sample.size)]
+        kf_idx = kf - 1
+        byte_offsets = chunk_offsets.astype(np.int64)[chunk_of_sample[kf_idx]] + offset_of_sample[kf_idx]
+        
+        return kf, byte_offsets
     
     def get_segment_offsets(self, start_time, end_time):
-        """Get byte offsets for a time range (simplified - uses sample numbers as proxy)"""
-        if not self.keyframes:
-            return None, None
-        
-        # For now, just return first and last keyframe offsets
-        # In production, you'd map timestamps to samples
+        """Get byte offsets of the keyframes bracketing a time range (seconds into the video)"""
         if len(self.keyframes) < 2:
             return None, None
         
-        return self.keyframes[0][1], self.keyframes[-1][1]
+        # Without stts/mdhd timing fall back to the whole file
+        if np.isnan(self.kf_times).any():
+            return self.keyframes[0][1], self.keyframes[-1][1]
+        
+        # Start at the last keyframe at or before start_time so decoding can begin there,
+        # end at the first keyframe at or after end_time
+        last = len(self.kf_times) - 1
+        lo = np.searchsorted(self.kf_times, start_time, side='right') - 1
+        hi = np.searchsorted(self.kf_times, end_time, side='left')
+        return int(self.kf_offsets[max(lo, 0)]), int(self.kf_offsets[min(hi, last)])
@@ -1,19 +1,102 @@
 import struct
 import os
+import re
+import mmap
 import json
 import time
 import subprocess
-from datetime import datetime
+import threading
+import operator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict, fields
+import numpy as np
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from mp4_parser import MP4Parser
+from parser_core import SEGMENT_LEN, SEGMENTS_PER_FILE, scan_segments
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 HEADER_LEN = 1280
 FILE_LEN = 80
-SEGMENT_LEN = 128
+PROBE_WORKERS = min(32, os.cpu_count() or 4)  # concurrent ffprobe processes per camera
+PROGRESS_INTERVAL = 0.25  # minimum seconds between progress file writes
+WATCH_DEBOUNCE = 2.0  # seconds of quiet before an index change triggers a parse
+ZSTD_LEVEL = 3  # metacache compression level when zstandard is installed
+
+_INDEX_HEADER = struct.Struct('<QIIIII')
+_VIDEO_NAME = re.compile(r'hiv(\d{5,})\.mp4')  # f'hiv{n:05d}.mp4', wider past 99999
+_U32LE = struct.Struct('<I')
+
+@dataclass(frozen=True)
+class SegmentLayout:
+    """Byte offsets of the fields read from each segment record"""
+    type_off: int = 0
+    start_time_off: int = 8  # 64-bit, only the low 32 bits are used
+    end_time_off: int = 16   # 64-bit, only the low 32 bits are used
+    
+    def __post_init__(self):
+        if not (0 <= self.type_off < self.start_time_off and
+                self.start_time_off + 8 <= self.end_time_off <= SEGMENT_LEN - 8):
+            raise ValueError(f"Unsupported segment layout: {self}")
+    
+    @property
+    def offsets(self):
+        return self.type_off, self.start_time_off, self.end_time_off
+
+LAYOUT_V1 = SegmentLayout()
+
+@dataclass(slots=True)
+class Segment:
+    """One recorded segment of a video file, times in epoch seconds"""
+    file: int
+    segment: int
+    start_time: int
+    end_time: int
+    start_offset: int  # Time offset in seconds within the video
+    end_offset: float
+
+SEGMENT_FIELDS = tuple(f.name for f in fields(Segment))
+_segment_row = operator.attrgetter(*SEGMENT_FIELDS)
+
+def _decode_segments(segs):
+    """Segments from a cached {'schema', 'rows'} table, or from the older list of dicts"""
+    if isinstance(segs, dict):
+        schema = segs['schema']
+        return [Segment(**dict(zip(schema, row))) for row in segs['rows']]
+    return [Segment(**seg) for seg in segs]
+
+def _dumps(obj):
+    """Serialize to JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        # orjson serializes dataclasses natively
+        return orjson.dumps(obj)
+    return json.dumps(obj, default=asdict).encode()
+
+def _loads(data):
+    """Deserialize JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _read_metacache(path):
+    """Load a metacache file, decompressing it if it is the .zst variant"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if path.endswith('.zst'):
+        data = zstandard.ZstdDecompressor().decompress(data)
+    return _loads(data)
 
 class FootageParser:
-    def __init__(self, datadirs, metacache_file, cameras):
+    def __init__(self, datadirs, metacache_file, cameras, layout=LAYOUT_V1):
         self.datadirs = []
         for i, cam_config in enumerate(cameras):
             path = cam_config['path']
@@ -26,46 +109,130 @@ class FootageParser:
                     'name': cam_config['name']
                 })
         self.metacache_file = metacache_file
+        # The repetitive segment table compresses ~10x, so the server reads far fewer bytes
+        self._cache_file = metacache_file + '.zst' if zstandard is not None else metacache_file
+        self.layout = layout
         self.file_mtimes = {}  # Track file modification times
+        self._index_stats = {}  # index path -> (mtime_ns, size) at last parse
+        self._segments = None  # cam_id -> [Segment] as last written to the cache
+        self._encoded = {}  # cam_id -> serialized segment list, reused while unchanged
+        self._progress_lock = threading.Lock()  # Cameras are parsed on worker threads
+        self._parse_lock = threading.Lock()  # Guards _parsing and _parse_pending
+        self._parsing = False  # A thread is running a parse
+        self._parse_pending = set()  # Index paths requested while a parse was running
+        self._progress = {}  # camera_idx -> (files_done, total_files) for the running parse
+        self._last_progress = 0  # time.monotonic() of the last progress write
+        
+        # Probed durations survive restarts: video path -> [size, mtime_ns, duration]
+        self._probe_cache_file = metacache_file + '.probes'
+        self._probe_cache = {}
+        self._probe_cache_dirty = False
+        try:
+            with open(self._probe_cache_file, 'rb') as f:
+                self._probe_cache = _loads(f.read())
+        except:
+            pass
     
     def _parse_info_bin(self, info_file):
         with open(info_file, 'rb') as f:
-            f.seek(64)
-            return struct.unpack('<I', f.read(4))[0]
+            return _U32LE.unpack_from(os.pread(f.fileno(), _U32LE.size, 64))[0]
     
     def parse_all(self):
-        segments_by_camera = {}
+        return self._parse_cameras(self.datadirs)
+    
+    def parse_camera(self, datadir):
+        """Re-parse a single camera's index, leaving the other cameras' segments as they are"""
+        return self._parse_cameras([datadir])
+    
+    def _parse_cameras(self, datadirs):
+        """Run one parse at a time; cameras requested meanwhile are parsed by the busy thread afterwards"""
+        with self._parse_lock:
+            self._parse_pending.update(d['index'] for d in datadirs)
+            if self._parsing:
+                return None
+            self._parsing = True
         
-        # Load existing cache to check what's already parsed
-        existing_cache = {}
-        existing_segments = {}
-        if os.path.exists(self.metacache_file):
-            try:
-                with open(self.metacache_file, 'r') as f:
-                    existing_cache = json.load(f)
-                    existing_segments = existing_cache.get('segments', {})
-            except:
-                pass
+        result = None
+        try:
+            while True:
+                with self._parse_lock:
+                    pending, self._parse_pending = self._parse_pending, set()
+                    if not pending:
+                        self._parsing = False
+                        return result
+                result = self._parse_changed([d for d in self.datadirs if d['index'] in pending]) or result
+        except:
+            with self._parse_lock:
+                self._parsing = False
+            raise
+    
+    def _parse_changed(self, datadirs):
+        # Only re-read index files that changed since the last parse
+        index_stats = {d['index']: self._stat_index(d['index']) for d in datadirs}
+        changed = {d['index'] for d in datadirs if self._index_stats.get(d['index']) != index_stats[d['index']]}
+        if not changed and os.path.exists(self._cache_file):
+            return None
+        
+        # Segments already parsed, read from the cache file once and then kept in memory
+        if self._segments is None:
+            self._load_cache()
         
         # Write initial progress
-        self._write_progress(0, len(self.datadirs), 0, 0)
+        self._progress = {}
+        self._write_progress(0, 0, 0)
+        
+        # Parse changed cameras in parallel; each index is independent and mostly I/O-bound
+        existing_mtimes = dict(self.file_mtimes)
+        jobs = [(idx, d) for idx, d in enumerate(self.datadirs) if d['index'] in changed]
+        with ThreadPoolExecutor(max_workers=min(16, len(jobs) or 1)) as executor:
+            results = executor.map(lambda job: self._parse_index(job[1], job[0], existing_mtimes), jobs)
+            new_by_index = dict(zip((d['index'] for _, d in jobs), results))
         
-        for idx, datadir in enumerate(self.datadirs):
+        segments_by_camera = {}
+        for datadir in self.datadirs:
             cam_id = str(datadir['num'])
             # Start with existing segments for this camera
-            segments_by_camera[cam_id] = existing_segments.get(cam_id, []).copy()
-            # Parse and add new/changed segments
-            new_segments = self._parse_index(datadir, idx, existing_cache.get('file_mtimes', {}))
-            segments_by_camera[cam_id].extend(new_segments)
+            segments_by_camera[cam_id] = self._segments.get(cam_id, []).copy()
+            if datadir['index'] not in new_by_index:
+                continue
+            # Swap in the segments of re-parsed files; only these cameras are serialized again
+            new_segments, new_mtimes, parsed_files = new_by_index[datadir['index']]
+            if parsed_files:
+                segments_by_camera[cam_id] = [s for s in segments_by_camera[cam_id] if s.file not in parsed_files]
+                segments_by_camera[cam_id].extend(new_segments)
+            self._encoded.pop(cam_id, None)
+            self.file_mtimes.update(new_mtimes)
         
-        cache_data = {
-            'cameras': [{'name': d['name'], 'path': d['path']} for d in self.datadirs],
-            'segments': segments_by_camera,
-            'file_mtimes': self.file_mtimes  # Track file modification times
-        }
+        for cam_id, segs in segments_by_camera.items():
+            if cam_id not in self._encoded:
+                # Column names once per camera, then one plain array per segment
+                self._encoded[cam_id] = _dumps({'schema': SEGMENT_FIELDS, 'rows': list(map(_segment_row, segs))})
         
-        with open(self.metacache_file, 'w') as f:
-            json.dump(cache_data, f)
+        # Splice the per-camera segment lists into the cache document
+        cache_bytes = b''.join([
+            b'{"cameras":', _dumps([{'name': d['name'], 'path': d['path']} for d in self.datadirs]),
+            b',"segments":{', b','.join(_dumps(cam_id) + b':' + self._encoded[cam_id] for cam_id in segments_by_camera),
+            b'},"file_mtimes":', _dumps(self.file_mtimes),  # Track file modification times
+            b'}'
+        ])
+        
+        # Write to a temp file and rename so readers never see a partial cache; syncing
+        # first keeps a crash from leaving an empty file under the cache's name
+        if zstandard is not None:
+            cache_bytes = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(cache_bytes)
+        tmp_file = self._cache_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(cache_bytes)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self._cache_file)
+        # Don't leave a stale copy in the other format for the server to find
+        stale_file = self.metacache_file if self._cache_file != self.metacache_file else self.metacache_file + '.zst'
+        if os.path.exists(stale_file):
+            os.remove(stale_file)
+        self._segments = segments_by_camera
+        self._index_stats.update(index_stats)
+        self._save_probe_cache()
         
         # Clear progress file
         progress_file = self.metacache_file.replace('.json', '.progress')
@@ -74,129 +241,217 @@ class FootageParser:
         
         return segments_by_camera
     
-    def _write_progress(self, camera_idx, total_cameras, files_done, total_files):
+    def _load_cache(self):
+        """Load existing cache to check what's already parsed"""
+        self._segments = {}
+        # An uncompressed cache from before zstandard was installed is still picked up
+        cache_file = next((p for p in (self._cache_file, self.metacache_file) if os.path.exists(p)), None)
+        if cache_file is not None:
+            try:
+                existing_cache = _read_metacache(cache_file)
+                self._segments = {cam_id: _decode_segments(segs)
+                                  for cam_id, segs in existing_cache.get('segments', {}).items()}
+                # Unchanged files keep their cached segments across restarts
+                self.file_mtimes = existing_cache.get('file_mtimes', {})
+            except:
+                pass
+    
+    def _stat_index(self, index_file):
+        st = os.stat(index_file)
+        return st.st_mtime_ns, st.st_size
+    
+    def _probe_duration(self, video_file):
+        """Video duration in seconds from the mvhd box or ffprobe, 0 on failure"""
+        try:
+            # Reading the movie header in-process avoids an ffprobe fork/exec per file
+            duration = MP4Parser(video_file).read_duration()
+            if duration:
+                return duration
+        except:
+            pass
+        try:
+            # Only the container duration is needed; skip ffprobe's stream analysis
+            result = subprocess.run(
+                ['ffprobe', '-v', 'quiet', '-threads', '1', '-probesize', '32k', '-analyzeduration', '0',
+                 '-select_streams', 'v:0', '-show_entries', 'format=duration',
+                 '-of', 'default=noprint_wrappers=1:nokey=1', video_file],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=5
+            )
+            return float(result.stdout.strip())
+        except:
+            return 0
+    
+    def _cached_duration(self, video_file, stat):
+        """Duration from the probe cache, running ffprobe only for new or changed files"""
+        sig = [stat.st_size, stat.st_mtime_ns]
+        cached = self._probe_cache.get(video_file)
+        if cached is not None and cached[:2] == sig:
+            return cached[2]
+        duration = self._probe_duration(video_file)
+        if duration > 0:
+            self._probe_cache[video_file] = sig + [duration]
+            self._probe_cache_dirty = True
+        return duration
+    
+    def _save_probe_cache(self):
+        if not self._probe_cache_dirty:
+            return
+        tmp_file = self._probe_cache_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(_dumps(self._probe_cache))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self._probe_cache_file)
+        self._probe_cache_dirty = False
+    
+    def _map_index(self, datadir):
+        """Memory-map a whole index file read-only, hinting sequential access to the kernel"""
+        with open(datadir['index'], 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mm, 'madvise'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        return mm
+    
+    def _scan_index(self, datadir, video_starts, video_durations):
+        """Scan the segment section of the index, keeping it mapped only for the scan"""
+        av_files = video_durations.size
+        u8 = None
+        index_data = self._map_index(datadir)
+        try:
+            # Segment section follows the header and file table
+            seg_start = min(HEADER_LEN + (av_files * FILE_LEN), len(index_data))
+            seg_len = min(av_files * SEGMENTS_PER_FILE * SEGMENT_LEN, len(index_data) - seg_start)
+            u8 = np.frombuffer(index_data, dtype=np.uint8, count=seg_len, offset=seg_start)
+            return scan_segments(u8, video_starts, video_durations, *self.layout.offsets)
+        finally:
+            # The array view must be gone before the mapping can be closed
+            u8 = None
+            try:
+                index_data.close()
+            except BufferError:
+                # A traceback still holds the view; the mapping is released with it
+                pass
+            # The index is read once per parse; leave the page cache to the recordings being served
+            self._drop_page_cache(datadir['index'])
+    
+    def _drop_page_cache(self, path):
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    
+    def _write_progress(self, camera_idx, files_done, total_files):
+        """Record one camera's progress and write the totals over all cameras being parsed"""
         progress_file = self.metacache_file.replace('.json', '.progress')
-        progress = {
-            'camera': camera_idx,
-            'total_cameras': total_cameras,
-            'files_done': files_done,
-            'total_files': total_files,
-            'timestamp': time.time()
-        }
-        with open(progress_file, 'w') as f:
-            json.dump(progress, f)
+        with self._progress_lock:
+            self._progress[camera_idx] = (files_done, total_files)
+            progress = {
+                'camera': camera_idx,
+                'total_cameras': len(self.datadirs),
+                'files_done': sum(done for done, _ in self._progress.values()),
+                'total_files': sum(total for _, total in self._progress.values()),
+                'timestamp': time.time()
+            }
+            
+            # Progress is reported per file; writing it that often costs more than the parse
+            now = time.monotonic()
+            if now - self._last_progress < PROGRESS_INTERVAL and progress['files_done'] != progress['total_files']:
+                return
+            self._last_progress = now
+            tmp_file = progress_file + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                f.write(_dumps(progress))
+            os.replace(tmp_file, progress_file)
     
     def _parse_index(self, datadir, camera_idx, existing_mtimes):
+        """Parse one camera's index, returning (segments, file_mtimes, file_nums) for new/changed files"""
+        file_mtimes = {}
+        
+        # Read header
         with open(datadir['index'], 'rb') as f:
-            # Read header
-            header_data = f.read(28)
-            vals = struct.unpack('<QIIIII', header_data)
-            av_files = vals[2]
-            
-            # Skip to segment section
-            f.seek(HEADER_LEN + (av_files * FILE_LEN))
-            
-            segments = []
+            vals = _INDEX_HEADER.unpack(f.read(_INDEX_HEADER.size))
+        av_files = vals[2]
+        
+        # Per-file video timeline; a zero duration tells the scanner to skip the file
+        video_starts = np.zeros(av_files, dtype=np.int64)
+        video_durations = np.zeros(av_files, dtype=np.float64)
+        
+        # List the directory once, keeping the indexed video files large enough to hold footage
+        valid_files = {}  # file_num -> (path, stat)
+        for entry in os.scandir(datadir['path']):
+            match = _VIDEO_NAME.fullmatch(entry.name)
+            if not match or int(match.group(1)) >= av_files:
+                continue
+            stat = entry.stat()
+            if stat.st_size > 1024:
+                valid_files[int(match.group(1))] = (entry.path, stat)
+        
+        # Update progress with total files
+        self._write_progress(camera_idx, 0, av_files)
+        
+        # Pick the files that need probing
+        probe_tasks = []  # (file_num, path, stat)
+        for file_num in sorted(valid_files):
+            path, stat = valid_files[file_num]
+            file_key = f"{camera_idx}_{file_num}"
             
-            # Update progress with total files
-            self._write_progress(camera_idx, len(self.datadirs), 0, av_files)
+            # Check if file has changed since last parse
+            current_mtime = stat.st_mtime
+            if file_key in existing_mtimes and existing_mtimes[file_key] == current_mtime:
+                continue
             
-            # Process each file's segments
-            for file_num in range(av_files):
+            # Store new mtime
+            file_mtimes[file_key] = current_mtime
+            probe_tasks.append((file_num, path, stat))
+        
+        # Get video durations, probing uncached files concurrently
+        with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+            durations = executor.map(lambda task: self._cached_duration(task[1], task[2]), probe_tasks)
+            for (file_num, _, stat), duration in zip(probe_tasks, durations):
                 # Update progress
-                self._write_progress(camera_idx, len(self.datadirs), file_num, av_files)
-                
-                video_file = os.path.join(datadir['path'], f'hiv{file_num:05d}.mp4')
-                file_key = f"{camera_idx}_{file_num}"
-                
-                if not os.path.exists(video_file):
-                    # Skip all 256 segments for this file
-                    f.seek(256 * SEGMENT_LEN, 1)
-                    continue
-                
-                stat = os.stat(video_file)
-                if stat.st_size <= 1024:
-                    f.seek(256 * SEGMENT_LEN, 1)
-                    continue
-                
-                # Check if file has changed since last parse
-                current_mtime = stat.st_mtime
-                if file_key in existing_mtimes and existing_mtimes[file_key] == current_mtime:
-                    # File unchanged, skip parsing but still read segment records
-                    f.seek(256 * SEGMENT_LEN, 1)
-                    continue
-                
-                # Store new mtime
-                self.file_mtimes[file_key] = current_mtime
-                
-                # Get video duration once per file
-                try:
-                    result = subprocess.run(
-                        ['ffprobe', '-v', 'quiet', '-show_entries', 'format=duration',
-                         '-of', 'default=noprint_wrappers=1:nokey=1', video_file],
-                        capture_output=True, text=True, timeout=5
-                    )
-                    video_duration = float(result.stdout.strip())
-                    video_start_time = int(stat.st_mtime)
-                except:
-                    video_duration = 0
-                    video_start_time = 0
-                
-                # Read 256 segment records for this file
-                for seg_idx in range(256):
-                    data = f.read(SEGMENT_LEN)
-                    if len(data) < SEGMENT_LEN:
-                        break
-                    
-                    seg_type = data[0]
-                    if seg_type == 0:
-                        continue
-                    
-                    # Extract timestamps
-                    start_time_64 = struct.unpack('<Q', data[8:16])[0]
-                    end_time_64 = struct.unpack('<Q', data[16:24])[0]
-                    
-                    # Convert timestamps
-                    start_time = start_time_64 & 0xFFFFFFFF
-                    end_time = end_time_64 & 0xFFFFFFFF
-                    
-                    # Skip invalid timestamps
-                    if end_time == 0 or start_time == 0:
-                        continue
-                    if end_time < start_time:
-                        continue
-                    
-                    # Calculate time offsets within video (in seconds)
-                    if video_duration > 0 and video_start_time > 0:
-                        # Map segment timestamps to video timeline
-                        seg_start_offset = max(0, start_time - video_start_time)
-                        seg_end_offset = min(video_duration, end_time - video_start_time)
-                        
-                        # Skip if outside video range
-                        if seg_start_offset >= video_duration or seg_end_offset <= 0:
-                            continue
-                        if seg_end_offset - seg_start_offset < 1:
-                            continue
-                        
-                        segments.append({
-                            'file': file_num,
-                            'segment': seg_idx,
-                            'start_time': start_time,
-                            'end_time': end_time,
-                            'start_offset': seg_start_offset,  # Time offset in seconds
-                            'end_offset': seg_end_offset
-                        })
-            
-            return segments
+                self._write_progress(camera_idx, file_num, av_files)
+                if duration > 0:
+                    video_durations[file_num] = duration
+                    video_starts[file_num] = int(stat.st_mtime)
+        self._write_progress(camera_idx, av_files, av_files)
+        
+        # Map segment timestamps to video timeline (in seconds)
+        columns = self._scan_index(datadir, video_starts, video_durations)
+        
+        segments = [Segment(*values) for values in zip(*(c.tolist() for c in columns))]
+        
+        return segments, file_mtimes, {file_num for file_num, _, _ in probe_tasks}
 
 class IndexWatcher(FileSystemEventHandler):
     def __init__(self, parser):
         self.parser = parser
+        self._datadirs = {os.path.abspath(d['index']): d for d in parser.datadirs}
+        self._pending = {}  # index path -> trailing threading.Timer for its next parse
+        self._lock = threading.Lock()
     
     def on_modified(self, event):
-        if event.src_path.endswith('index00.bin'):
-            print(f"Index updated: {event.src_path}")
-            self.parser.parse_all()
+        index_file = os.path.abspath(event.src_path)
+        if index_file not in self._datadirs:
+            return
+        
+        # Cameras rewrite the index in bursts; parse once after they settle
+        with self._lock:
+            if index_file in self._pending:
+                self._pending[index_file].cancel()
+            timer = threading.Timer(WATCH_DEBOUNCE, self._parse, args=(index_file,))
+            timer.daemon = True
+            self._pending[index_file] = timer
+            timer.start()
+    
+    def _parse(self, index_file):
+        with self._lock:
+            self._pending.pop(index_file, None)
+        print(f"Index updated: {index_file}")
+        # Only the camera whose index changed needs parsing
+        self.parser.parse_camera(self._datadirs[index_file])
 
 def run_parser(datadirs, metacache_file, interval, cameras):
     parser = FootageParser(datadirs, metacache_file, cameras)
@@ -214,6 +469,8 @@ def run_parser(datadirs, metacache_file, interval, cameras):
     observer.start()
     
     try:
+        # The watcher handles index changes; this periodic pass only catches missed
+        # events and is a couple of stat calls when nothing changed
         while True:
             parser.parse_all()
             time.sleep(interval)
@@ -0,0 +1,126 @@
+import functools
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+SEGMENT_LEN = 128
+SEGMENTS_PER_FILE = 256
+MAX_EMPTY_RUN = 4  # consecutive empty slots that end a file's segment list
+
+def _jit(func):
+    """Compile with numba when it is installed, otherwise run as plain Python"""
+    if njit is None:
+        return func
+    # nogil lets the per-camera worker threads scan indexes in parallel
+    return njit(cache=True, nogil=True)(func)
+
+@_jit
+def _le32(u8, pos):
+    return (np.int64(u8[pos]) | (np.int64(u8[pos + 1]) << 8) |
+            (np.int64(u8[pos + 2]) << 16) | (np.int64(u8[pos + 3]) << 24))
+
+@_jit
+def scan_segments(u8, video_starts, video_durations, type_off, start_time_off, end_time_off):
+    """Scan raw segment records and return the valid ones as parallel arrays
+
+    Files with a non-positive duration in video_durations are skipped. Field
+    offsets come from a SegmentLayout; only the low 32 bits of the 64-bit
+    start/end timestamps are used.
+    """
+    n_records = min(u8.size // SEGMENT_LEN, video_durations.size * SEGMENTS_PER_FILE)
+    keep = np.zeros(n_records, dtype=np.bool_)
+    for file_num in range(video_durations.size):
+        duration = video_durations[file_num]
+        video_start = video_starts[file_num]
+        if duration <= 0 or video_start <= 0:
+            continue
+        
+        # Segments fill a file's slots from the start; stop after a run of empty slots
+        empty_run = 0
+        first = file_num * SEGMENTS_PER_FILE
+        for i in range(first, min(first + SEGMENTS_PER_FILE, n_records)):
+            base = i * SEGMENT_LEN
+            if u8[base + type_off] == 0:
+                empty_run += 1
+                if empty_run >= MAX_EMPTY_RUN:
+                    break
+                continue
+            empty_run = 0
+            
+            start_time = _le32(u8, base + start_time_off)
+            end_time = _le32(u8, base + end_time_off)
+            if start_time == 0 or end_time == 0 or end_time < start_time:
+                continue
+            
+            # Skip if outside video range or shorter than a second
+            seg_start_offset = max(0, start_time - video_start)
+            seg_end_offset = min(duration, end_time - video_start)
+            if seg_start_offset >= duration or seg_end_offset <= 0:
+                continue
+            if seg_end_offset - seg_start_offset < 1:
+                continue
+            keep[i] = True
+    
+    idx = np.nonzero(keep)[0]
+    files = idx // SEGMENTS_PER_FILE
+    segs = idx % SEGMENTS_PER_FILE
+    start_times = np.empty(idx.size, dtype=np.int64)
+    end_times = np.empty(idx.size, dtype=np.int64)
+    start_offsets = np.empty(idx.size, dtype=np.int64)
+    end_offsets = np.empty(idx.size, dtype=np.float64)
+    for j in range(idx.size):
+        base = idx[j] * SEGMENT_LEN
+        video_start = video_starts[files[j]]
+        start_times[j] = _le32(u8, base + start_time_off)
+        end_times[j] = _le32(u8, base + end_time_off)
+        start_offsets[j] = max(0, start_times[j] - video_start)
+        end_offsets[j] = min(video_durations[files[j]], end_times[j] - video_start)
+    
+    return files, segs, start_times, end_times, start_offsets, end_offsets
+
+@functools.lru_cache(maxsize=None)
+def _record_dtype(type_off, start_time_off, end_time_off):
+    """Structured dtype viewing a segment record's type and 64-bit start/end times"""
+    return np.dtype({'names': ['type', 'start', 'end'], 'formats': ['u1', '<u8', '<u8'],
+                     'offsets': [type_off, start_time_off, end_time_off], 'itemsize': SEGMENT_LEN})
+
+def _scan_segments_np(u8, video_starts, video_durations, type_off, start_time_off, end_time_off):
+    """Vectorized scan_segments over a structured record view, used when numba is not installed"""
+    n_records = min(u8.size // SEGMENT_LEN, video_durations.size * SEGMENTS_PER_FILE)
+    records = np.frombuffer(u8, dtype=_record_dtype(type_off, start_time_off, end_time_off), count=n_records)
+    
+    # Only gather the slots of files that have a video, so absent files' records are never touched
+    active = np.nonzero((video_durations > 0) & (video_starts > 0))[0]
+    active = active[active * SEGMENTS_PER_FILE < n_records]
+    slots = active[:, None] * SEGMENTS_PER_FILE + np.arange(SEGMENTS_PER_FILE)
+    
+    # One row of slots per file; slots missing from a truncated index read as empty
+    present = slots < n_records
+    slots = np.where(present, slots, 0)
+    types = np.where(present, records['type'][slots], 0)
+    start_times = np.where(present, records['start'][slots] & 0xFFFFFFFF, 0).astype(np.int64)
+    end_times = np.where(present, records['end'][slots] & 0xFFFFFFFF, 0).astype(np.int64)
+    
+    # Length of the run of empty slots ending at each slot; a file's list ends at the first long run
+    empty = types == 0
+    empties = np.cumsum(empty, axis=1)
+    empty_run = empties - np.maximum.accumulate(np.where(empty, 0, empties), axis=1)
+    in_list = np.cumsum(empty_run >= MAX_EMPTY_RUN, axis=1) == 0
+    
+    durations = video_durations[active, None]
+    starts = video_starts[active, None]
+    seg_start_offsets = np.maximum(0, start_times - starts)
+    seg_end_offsets = np.minimum(durations, end_times - starts)
+    keep = (in_list & ~empty & (start_times != 0) & (end_times != 0) & (end_times >= start_times) &
+            (seg_start_offsets < durations) & (seg_end_offsets > 0) &
+            (seg_end_offsets - seg_start_offsets >= 1))
+    
+    rows, segs = np.nonzero(keep)
+    return (active[rows].astype(np.int64), segs.astype(np.int64), start_times[keep], end_times[keep],
+            seg_start_offsets[keep], seg_end_offsets[keep].astype(np.float64))
+
+if njit is None:
+    scan_segments = _scan_segments_np
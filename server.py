@@ -1,105 +1,267 @@
-from flask import Flask, render_template, request, send_file, jsonify, Response
+from flask import Flask, stream_template, request, send_file, jsonify, Response
 import os
 import json
 import configparser
 import subprocess
-import hashlib
-from datetime import datetime, timedelta
+import threading
+import time
+from urllib.parse import quote
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import av
+except ImportError:
+    av = None
 
 app = Flask(__name__)
 config = None
 
-def load_segments():
+VIDEO_MAX_AGE = 3600  # seconds browsers may reuse an extracted segment without asking
+ACCEL_REDIRECT_PREFIX = '/protected/'  # default internal nginx location of the extract cache
+ACCEL_REDIRECT_SOURCE_PREFIX = '/protected-source/'  # default internal nginx location of the filesystem root
+
+# Part of the index page's ETag, so a restart with a new config or template invalidates it
+_STARTED = time.time_ns()
+
+# Internal location prefixes for X-Accel-Redirect, set at startup when nginx sends the files
+accel_redirect = {}
+
+def _read_accel_redirect(config):
+    """Check the X-Accel-Redirect prefixes once, so a bad setting fails at startup and not per request"""
+    if config.get('app', 'sendfile', fallback='') != 'x-accel-redirect':
+        return {}
+    prefixes = {}
+    for kind, option, default in (('cache', 'accel_redirect_prefix', ACCEL_REDIRECT_PREFIX),
+                                  ('source', 'accel_redirect_source_prefix', ACCEL_REDIRECT_SOURCE_PREFIX)):
+        prefix = config.get('app', option, fallback=default)
+        if not prefix.startswith('/') or not prefix.endswith('/'):
+            raise ValueError(f"[app] {option} must start and end with '/': {prefix!r}")
+        prefixes[kind] = prefix
+    return prefixes
+
+# Parsed metacache, reloaded only when the parser replaces the file
+_segments_cache = {'key': None, 'data': None}
+_segments_lock = threading.Lock()
+
+def _metacache_path():
+    """The metacache as the parser writes it, zstd-compressed when zstandard is installed"""
     metacache_file = config.get('storage', 'metacache_file')
-    if os.path.exists(metacache_file):
-        with open(metacache_file, 'r') as f:
-            data = json.load(f)
-            # Handle old format (list) or new format (dict with grouped segments)
-            if isinstance(data, list):
-                return {'cameras': [], 'segments': {}}
-            if 'segments' in data and isinstance(data['segments'], list):
-                # Old format with flat list
-                return {'cameras': data.get('cameras', []), 'segments': {}}
-            return data
-    return {'cameras': [], 'segments': {}}
+    if zstandard is not None and os.path.exists(metacache_file + '.zst'):
+        return metacache_file + '.zst'
+    return metacache_file
+
+def load_segments():
+    metacache_file = _metacache_path()
+    try:
+        st = os.stat(metacache_file)
+    except OSError:
+        return {'cameras': [], 'segments': {}}
+    
+    key = (metacache_file, st.st_mtime_ns, st.st_size)
+    with _segments_lock:
+        if _segments_cache['key'] != key:
+            _segments_cache['data'] = _read_segments(metacache_file)
+            _segments_cache['key'] = key
+        return _segments_cache['data']
+
+SEGMENT_FIELDS = ('file', 'segment', 'start_time', 'end_time', 'start_offset', 'end_offset')
+
+def _read_segments(metacache_file):
+    with open(metacache_file, 'rb') as f:
+        raw = f.read()
+        if metacache_file.endswith('.zst'):
+            raw = zstandard.ZstdDecompressor().decompress(raw)
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+        # Handle old format (list) or new format (dict with grouped segments)
+        if isinstance(data, list):
+            return {'cameras': [], 'segments': {}}
+        if 'segments' in data and isinstance(data['segments'], list):
+            # Old format with flat list
+            return {'cameras': data.get('cameras', []), 'segments': {}}
+        # Keep each camera's segments as one array per field; the parser writes a
+        # column schema plus rows, older caches a list of dicts
+        data['last_recordings'] = {}
+        for cam_id, segs in data.get('segments', {}).items():
+            if isinstance(segs, dict):
+                cols = _to_columns(segs['schema'], segs['rows'])
+            else:
+                cols = _to_columns(SEGMENT_FIELDS, [[s[k] for k in SEGMENT_FIELDS] for s in segs])
+            
+            # Last recording per camera
+            if len(cols['start_time']):
+                latest = int(np.argmax(cols['start_time']))
+                data['last_recordings'][int(cam_id)] = f"File {cols['file'][latest]}"
+            data['segments'][cam_id] = _sort_segments(cols)
+        return data
+
+def _to_columns(schema, rows):
+    columns = list(zip(*rows)) or [()] * len(schema)
+    return {name: np.array(col) if col else np.empty(0, dtype=np.int64) for name, col in zip(schema, columns)}
+
+def _sort_segments(cols):
+    """Sort a camera's columns by file and segment number, keeping the first of any duplicates"""
+    order = np.lexsort((cols['segment'], cols['file']))  # Stable
+    files = cols['file'][order]
+    segs = cols['segment'][order]
+    first = np.ones(order.size, dtype=bool)
+    first[1:] = (files[1:] != files[:-1]) | (segs[1:] != segs[:-1])
+    return {name: col[order[first]] for name, col in cols.items()}
+
+def _find_segment(cols, file_num, segment_num):
+    """Row of a segment in a camera's sorted columns, None if it is not there"""
+    lo = np.searchsorted(cols['file'], file_num, side='left')
+    hi = np.searchsorted(cols['file'], file_num, side='right')
+    row = lo + np.searchsorted(cols['segment'][lo:hi], segment_num)
+    if row < hi and cols['segment'][row] == segment_num:
+        return int(row)
+    return None
+
+# Last progress document read, as (mtime_ns, size) and the raw JSON body
+_progress_cache = {'key': None, 'body': None}
+_progress_lock = threading.Lock()
 
 @app.route('/progress')
 def progress():
     metacache_file = config.get('storage', 'metacache_file')
     progress_file = metacache_file.replace('.json', '.progress')
     
-    if os.path.exists(progress_file):
-        with open(progress_file, 'r') as f:
-            return jsonify(json.load(f))
-    else:
+    try:
+        st = os.stat(progress_file)
+    except OSError:
         return jsonify({'done': True})
+    
+    # Clients poll this while a parse runs; the file is only read again after the
+    # parser replaces it, and its JSON is passed through without re-encoding
+    key = (st.st_mtime_ns, st.st_size)
+    with _progress_lock:
+        if _progress_cache['key'] != key:
+            try:
+                with open(progress_file, 'rb') as f:
+                    _progress_cache['body'] = f.read()
+            except OSError:
+                return jsonify({'done': True})
+            _progress_cache['key'] = key
+        return Response(_progress_cache['body'], mimetype='application/json')
 
 @app.route('/')
 def index():
     camera = request.args.get('camera', type=int)
     
+    # The page only changes with the metacache, the camera filter and the running
+    # server; stat before loading so a cache replaced in between is never tagged
+    # with the old version
+    metacache_file = _metacache_path()
+    try:
+        st = os.stat(metacache_file)
+        cache_size = st.st_size
+        etag = f'{_STARTED}-{st.st_mtime_ns}-{st.st_size}-{camera}'
+    except OSError:
+        cache_size = 0
+        etag = f'{_STARTED}-none-{camera}'
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    
     data = load_segments()
     cameras = [{'id': i, 'name': c['name']} for i, c in enumerate(data['cameras'])]
     
-    # Flatten segments from all cameras
-    all_segments = []
-    for cam_id, segs in data['segments'].items():
-        for seg in segs:
-            seg['camera_id'] = int(cam_id)
-            all_segments.append(seg)
-    
-    # Remove duplicates (same camera_id, file, segment)
-    seen = set()
-    unique_segments = []
-    for seg in all_segments:
-        key = (seg['camera_id'], seg['file'], seg['segment'])
-        if key not in seen:
-            seen.add(key)
-            unique_segments.append(seg)
-    
-    # Filter by camera if specified
-    if camera is not None:
-        unique_segments = [s for s in unique_segments if s['camera_id'] == camera]
-    
-    # Sort by camera_id, then file number, then segment number
-    unique_segments.sort(key=lambda s: (s['camera_id'], s['file'], s['segment']))
+    # Stream the page so the first rows reach the browser while the rest render
+    response = Response(_buffered(stream_template('index.html', 
+                                              files=_file_groups(data, camera),
+                                              cameras=cameras,
+                                              selected_camera=camera,
+                                              cache_size=_human_size(cache_size),
+                                              last_recordings=data.get('last_recordings', {}),
+                                              title=config.get('app', 'title'))))
+    # Browsers revalidate on every visit and get a 304 while nothing changed
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def _buffered(chunks, size=64 * 1024):
+    """Join Jinja's many small output chunks so each write to the client is sizeable"""
+    buf = []
+    buffered = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield ''.join(buf)
+            buf = []
+            buffered = 0
+    if buf:
+        yield ''.join(buf)
+
+_SIZE_UNITS = ('B', 'KB', 'MB')
+
+def _human_size(n):
+    """Byte count in B, KB or MB, the unit picked from the number's bit length"""
+    unit = max(0, min((n.bit_length() - 1) // 10, len(_SIZE_UNITS) - 1))
+    if not unit:
+        return f'{n} B'
+    return f'{n / (1 << 10 * unit):.1f} {_SIZE_UNITS[unit]}'
+
+def _file_groups(data, camera):
+    """Segment rows grouped by recording file, built once per cache load for each camera filter"""
+    # Only memoize filters naming a cached camera, so arbitrary ?camera= values can't grow the memo
+    if camera is not None and str(camera) not in data['segments']:
+        return _group_by_file(data, camera)
+    pages = data.setdefault('pages', {})
+    if camera not in pages:
+        pages[camera] = _group_by_file(data, camera)
+    return pages[camera]
+
+def _group_by_file(data, camera):
+    # Cameras are kept sorted and de-duplicated by file and segment number, so
+    # concatenating them in camera order sorts by camera_id, file, segment
+    segments = data['segments']
+    if camera is None:
+        cam_ids = sorted(segments, key=int)
+    else:
+        # Filter by camera if specified
+        cam_ids = [cam_id for cam_id in segments if int(cam_id) == camera]
+    camera_ids = np.concatenate([np.full(len(segments[cam_id]['file']), int(cam_id), dtype=np.int64)
+                                 for cam_id in cam_ids] or [np.empty(0, dtype=np.int64)])
+    columns = {name: np.concatenate([segments[cam_id][name] for cam_id in cam_ids] or [np.empty(0, dtype=np.int64)])
+               for name in SEGMENT_FIELDS}
     
     # Create camera lookup
     camera_map = {i: c for i, c in enumerate(data['cameras'])}
     
-    # Calculate metadata
-    metacache_file = config.get('storage', 'metacache_file')
-    cache_size = os.path.getsize(metacache_file) if os.path.exists(metacache_file) else 0
-    if cache_size < 1024:
-        cache_size_str = f'{cache_size} B'
-    elif cache_size < 1024**2:
-        cache_size_str = f'{cache_size/1024:.1f} KB'
-    else:
-        cache_size_str = f'{cache_size/1024**2:.1f} MB'
+    # Calculate size from duration, rough estimate: 1-2 Mbps for H.264
+    durations = columns['end_time'] - columns['start_time']
+    estimated = np.where(durations > 0, durations * 150000, 0)  # ~1.2 Mbps
     
-    # Get last recording per camera
-    last_recordings = {}
-    for cam_id, segs in data['segments'].items():
-        if segs:
-            latest = max(segs, key=lambda s: s.get('start_time', 0))
-            last_recordings[int(cam_id)] = f"File {latest['file']}"
+    # Only the displayed rows become dicts
+    row_values = zip(camera_ids.tolist(), *(columns[name].tolist() for name in SEGMENT_FIELDS),
+                     durations.tolist(), estimated.tolist())
     
     # Group by file number instead of day
     by_file = {}
-    for seg in unique_segments:
-        cam = camera_map.get(seg['camera_id'], {})
+    for camera_id, *values, duration, estimated_bytes in row_values:
+        seg = dict(zip(SEGMENT_FIELDS, values))
+        seg['camera_id'] = camera_id
+        cam = camera_map.get(camera_id, {})
         file_key = f"hiv{seg['file']:05d}.mp4"
         if file_key not in by_file:
             by_file[file_key] = []
         
         seg['path'] = cam.get('path', '')
-        seg['name'] = cam.get('name', f"Camera {seg['camera_id']}")
+        seg['name'] = cam.get('name', f"Camera {camera_id}")
         
-        # Calculate size from duration
-        duration = seg['end_time'] - seg['start_time']
         if duration > 0:
-            # Rough estimate: 1-2 Mbps for H.264
-            estimated_bytes = duration * 150000  # ~1.2 Mbps
             seg['size_bytes'] = estimated_bytes
             if estimated_bytes < 1024**2:
                 seg['size'] = f'~{estimated_bytes/1024:.0f} KB'
@@ -111,13 +273,69 @@ def index():
         
         by_file[file_key].append(seg)
     
-    return render_template('index.html', 
-                         files=sorted(by_file.items()),
-                         cameras=cameras,
-                         selected_camera=camera,
-                         cache_size=cache_size_str,
-                         last_recordings=last_recordings,
-                         title=config.get('app', 'title'))
+    return sorted(by_file.items())
+
+@app.route('/source')
+def source():
+    """Serve a whole recording; players seek in it with Range requests and a #t= fragment"""
+    camera_id = request.args.get('camera_id', type=int)
+    file_num = request.args.get('file', type=int)
+    
+    data = load_segments()
+    camera_map = {i: c for i, c in enumerate(data['cameras'])}
+    
+    cam = camera_map.get(camera_id)
+    if not cam:
+        return "Camera not found", 404
+    if file_num is None:
+        return "Video file not found", 404
+    
+    video_file = os.path.join(cam['path'], f'hiv{file_num:05d}.mp4')
+    if not os.path.exists(video_file):
+        return "Video file not found", 404
+    
+    # The camera keeps writing the current recording and reuses names on rotation,
+    # so browsers must revalidate; unchanged files still get cheap 304s and 206s
+    if accel_redirect:
+        response = Response(mimetype='video/mp4')
+        response.headers['X-Accel-Redirect'] = accel_redirect['source'] + quote(os.path.abspath(video_file).lstrip('/'))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    
+    return send_file(video_file, mimetype='video/mp4', as_attachment=False,
+                     conditional=True, etag=True, max_age=0)
+
+def _extract_segment(video_file, start_time, duration, cached_file):
+    """Copy the video stream between two offsets into a new mp4 in-process, without re-encoding"""
+    tmp_file = f'{cached_file}.{threading.get_ident()}.tmp'
+    try:
+        with av.open(video_file) as src, av.open(tmp_file, 'w', format='mp4') as dst:
+            in_stream = src.streams.video[0]
+            out_stream = dst.add_stream_from_template(in_stream)
+            # Like ffmpeg -ss with stream copy, start at the keyframe before start_time
+            src.seek(int(start_time / in_stream.time_base), stream=in_stream)
+            end_pts = (start_time + duration) / in_stream.time_base
+            first_dts = None
+            for packet in src.demux(in_stream):
+                if packet.dts is None:  # Flush packet at the end of the stream
+                    continue
+                if packet.dts >= end_pts:
+                    break
+                if packet.pts is None or packet.pts >= end_pts:
+                    continue
+                # Shift timestamps to start at zero, as -avoid_negative_ts make_zero does
+                if first_dts is None:
+                    first_dts = packet.dts
+                packet.dts -= first_dts
+                packet.pts -= first_dts
+                packet.stream = out_stream
+                dst.mux(packet)
+            if first_dts is None:
+                raise ValueError(f"No video between {start_time}s and {start_time + duration}s")
+        os.replace(tmp_file, cached_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
 
 @app.route('/video')
 def video():
@@ -133,10 +351,11 @@ def video():
         return "Camera not found", 404
     
     # Find segment info
-    segments = data['segments'].get(str(camera_id), [])
-    segment = next((s for s in segments if s['file'] == file_num and s['segment'] == segment_num), None)
-    if not segment:
+    cols = data['segments'].get(str(camera_id))
+    row = _find_segment(cols, file_num, segment_num) if cols and file_num is not None and segment_num is not None else None
+    if row is None:
         return "Segment not found", 404
+    segment = {name: cols[name][row].item() for name in SEGMENT_FIELDS}
     
     video_file = os.path.join(cam['path'], f'hiv{file_num:05d}.mp4')
     if not os.path.exists(video_file):
@@ -146,17 +365,22 @@ def video():
     cache_dir = '/opt/footage-browser/cache'
     os.makedirs(cache_dir, exist_ok=True)
     
-    # Generate cache filename based on segment info
+    # Generate cache filename based on segment info; the key is a safe file name as it is
     cache_key = f"{camera_id}_{file_num}_{segment_num}_{segment['start_offset']}_{segment['end_offset']}"
-    cache_hash = hashlib.md5(cache_key.encode()).hexdigest()
-    cached_file = os.path.join(cache_dir, f'{cache_hash}.mp4')
+    cached_file = os.path.join(cache_dir, f'{cache_key}.mp4')
     
     # Extract segment if not cached
+    start_time = segment['start_offset']  # Time in seconds
+    end_time = segment['end_offset']
+    duration = end_time - start_time
+    if av is not None and not os.path.exists(cached_file):
+        # Remuxing with PyAV saves an ffmpeg process per extract; ffmpeg stays the fallback
+        try:
+            _extract_segment(video_file, start_time, duration, cached_file)
+        except Exception:
+            pass
+    
     if not os.path.exists(cached_file):
-        start_time = segment['start_offset']  # Time in seconds
-        end_time = segment['end_offset']
-        duration = end_time - start_time
-        
         # Use ffmpeg to extract segment by time
         try:
             cmd = [
@@ -180,11 +404,24 @@ def video():
         except Exception as e:
             return f"Error: {str(e)}", 500
     
-    return send_file(cached_file, mimetype='video/mp4', as_attachment=False)
+    # Hand the transfer to nginx, which sends the file with sendfile(2) from an internal location
+    if accel_redirect:
+        response = Response(mimetype='video/mp4')
+        response.headers['X-Accel-Redirect'] = accel_redirect['cache'] + os.path.basename(cached_file)
+        response.headers['Cache-Control'] = f'public, max-age={VIDEO_MAX_AGE}'
+        return response
+    
+    # Let the browser revalidate replays with ETag/Last-Modified and serve Range requests as 206
+    return send_file(cached_file, mimetype='video/mp4', as_attachment=False,
+                     conditional=True, etag=True, max_age=VIDEO_MAX_AGE)
 
 if __name__ == '__main__':
     config = configparser.ConfigParser()
     config.read('/etc/footage-browser/app.conf')
     
+    # Apache/lighttpd front ends send the file named in the X-Sendfile header themselves
+    app.use_x_sendfile = config.get('app', 'sendfile', fallback='') == 'x-sendfile'
+    accel_redirect = _read_accel_redirect(config)
+    
     app.run(host=config.get('app', 'host'), 
             port=config.getint('app', 'port'))